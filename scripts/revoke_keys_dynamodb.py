@@ -8,21 +8,51 @@
 
 import argparse
 import boto3
+import concurrent.futures
+import contextlib
+import itertools
 import json
 import logging
 import os
+import queue
+import threading
 import time
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Key, Attr, ConditionExpressionBuilder
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+DEFAULT_SEGMENTS = min((os.cpu_count() or 1) * 4, 16)
+DEFAULT_WRITE_CAPACITY_FRACTION = 0.5
+DEFAULT_MAX_WORKERS = 16
+# Number of keys buffered and sorted before being written, which bounds memory use regardless of table size
+REVOKE_WINDOW_SIZE = 1000
+INITIAL_BACKOFF_SECONDS = 0.05
+MAX_BACKOFF_SECONDS = 20
+QUEUE_PUT_TIMEOUT_SECONDS = 0.5
+
 TABLE_NAME = 'EncryptionKey'
 PARTITION_KEY = 'Id'
 SORT_KEY = 'Created'
 KEY_RECORD = 'KeyRecord'
 REVOKED = 'Revoked'
 KEY_RECORD_REVOKED_FULLY_QUALIFIED = '{}.{}'.format(KEY_RECORD, REVOKED)
+TYPE = 'Type'
+TYPE_CREATED_INDEX = 'TypeCreatedIndex'
+# Maps the key id prefix to the value stored in the Type attribute by the migrate action
+ID_PREFIX_TO_TYPE = {
+    '_SK_': 'SK',
+    '_IK_': 'IK',
+}
+# Only what's needed to filter and update, which leaves the key material behind
+REVOKE_PROJECTION_EXPRESSION = '#id, #cr, #kr.#rv'
+REVOKE_EXPRESSION_ATTRIBUTE_NAMES = {
+    '#id': PARTITION_KEY,
+    '#cr': SORT_KEY,
+    '#kr': KEY_RECORD,
+    '#rv': REVOKED,
+}
 
 
 def revoke_envelope_key_record_by_key(table, execute_flag, id, created):
@@ -62,61 +92,346 @@ def revoke_envelope_key_record_by_key(table, execute_flag, id, created):
         logger.warning('Envelope key record for id={}, created={} not found!'.format(id, created))
 
 
-def revoke_intermediate_keys_by_created(table, execute_flag, created):
-    return revoke_envelope_key_records_by_created_and_id_prefix(table, execute_flag, created, '_IK_')
+class TokenBucket:
+    """Thread safe token bucket that refills at rate tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def capacity_fraction(value):
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError('{} is not a fraction greater than 0 and at most 1'.format(value))
+    return fraction
+
+
+def revoke_intermediate_keys_by_created(table, execute_flag, created, use_index=False, segments=1,
+                                        write_capacity_fraction=DEFAULT_WRITE_CAPACITY_FRACTION,
+                                        max_workers=DEFAULT_MAX_WORKERS):
+    return revoke_envelope_key_records_by_created_and_id_prefix(table, execute_flag, created, '_IK_', use_index, segments,
+                                                                write_capacity_fraction, max_workers)
 
 
-def revoke_system_keys_by_created(table, execute_flag, created):
-    return revoke_envelope_key_records_by_created_and_id_prefix(table, execute_flag, created, '_SK_')
+def revoke_system_keys_by_created(table, execute_flag, created, use_index=False, segments=1,
+                                  write_capacity_fraction=DEFAULT_WRITE_CAPACITY_FRACTION,
+                                  max_workers=DEFAULT_MAX_WORKERS):
+    return revoke_envelope_key_records_by_created_and_id_prefix(table, execute_flag, created, '_SK_', use_index, segments,
+                                                                write_capacity_fraction, max_workers)
 
 
-def revoke_envelope_key_records_by_created_and_id_prefix(table, execute_flag, created, id_prefix):
-    results = get_all_items_to_revoke(table, created, id_prefix)
+def revoke_envelope_key_records_by_created_and_id_prefix(table, execute_flag, created, id_prefix, use_index=False,
+                                                         segments=1,
+                                                         write_capacity_fraction=DEFAULT_WRITE_CAPACITY_FRACTION,
+                                                         max_workers=DEFAULT_MAX_WORKERS):
+    if use_index:
+        items = iter_items_to_revoke_from_index(table, created, id_prefix)
+    else:
+        items = iter_items_to_revoke(table, created, id_prefix, segments)
 
-    logger.info('Fetched {} rows to revoke using id_prefix={}, created<{}'.format(len(results), id_prefix, created))
+    # Closed explicitly so a failed or interrupted revoke stops any segments still scanning, rather than waiting on
+    # garbage collection
+    with contextlib.closing(items):
+        revoke_items(table, execute_flag, items, created, id_prefix, write_capacity_fraction, max_workers)
 
-    # Sort by created to distribute across partitions (avoid hot partitions)
-    results = sorted(results, key=lambda i: i[SORT_KEY])
 
+def revoke_items(table, execute_flag, items, created, id_prefix, write_capacity_fraction, max_workers):
+    count = 0
     if execute_flag:
-        # batch_writer handles batching and sending for us automatically
-        with table.batch_writer() as batch:
-            for item in results:
-                item[KEY_RECORD][REVOKED] = True
-                batch.put_item(item)
+        rate_limiter = create_write_rate_limiter(table, write_capacity_fraction)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for window in iter_chunks(items, REVOKE_WINDOW_SIZE):
+                # Sort by created to distribute across partitions (avoid hot partitions)
+                window.sort(key=lambda i: i[SORT_KEY])
+
+                # Consume the results so any error raised by a worker is propagated
+                for revoked in executor.map(lambda item: update_item_revoked(table, item, rate_limiter), window):
+                    if revoked:
+                        count += 1
 
-        logger.info('Marked {} keys revoked successfully!'.format(len(results)))
+                logger.info('Marked {} keys revoked so far'.format(count))
+
+        logger.info('Marked {} keys revoked successfully using id_prefix={}, created<{}!'.format(count, id_prefix, created))
     else:
-        logger.info('DRY-RUN would have run batch_writer.put_item for {} keys'.format(len(results)))
+        for _ in items:
+            count += 1
+
+        logger.info('DRY-RUN would have run update_item for {} keys using id_prefix={}, created<{}'.format(
+            count, id_prefix, created))
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def create_write_rate_limiter(table, write_capacity_fraction):
+    # On-demand tables report 0 write capacity units, in which case there's nothing to limit against
+    write_capacity_units = table.provisioned_throughput['WriteCapacityUnits']
+    if not write_capacity_units:
+        return None
+
+    # Each update of the revoked flag consumes a single WCU, as key records are well under 1KB
+    rate = write_capacity_units * write_capacity_fraction
+    logger.info('Limiting updates to {} WCU/s'.format(rate))
+    return TokenBucket(rate, max(rate, 1))
+
+
+def update_item_revoked(table, item, rate_limiter=None):
+    # Sets just the flag rather than replacing the whole item, so there's no read-modify-write race
+    return update_item_with_retry(
+        table,
+        item,
+        rate_limiter,
+        UpdateExpression='set #kr.#rv = :r',
+        ConditionExpression='attribute_exists(#kr)',
+        ExpressionAttributeNames={'#kr': KEY_RECORD, '#rv': REVOKED},
+        ExpressionAttributeValues={':r': True}
+    )
+
+
+def update_item_with_retry(table, item, rate_limiter=None, **update_args):
+    backoff = INITIAL_BACKOFF_SECONDS
 
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire(1)
+
+        try:
+            # Uses the resource's client as it handles the conversion to and from DynamoDB types for us. The expressions
+            # must stay plain strings, as condition objects aren't safe to pass it from several threads (see
+            # build_condition_args)
+            table.meta.client.update_item(
+                TableName=table.name,
+                Key={
+                    PARTITION_KEY: item[PARTITION_KEY],
+                    SORT_KEY: item[SORT_KEY]
+                },
+                **update_args
+            )
+            return True
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == 'ConditionalCheckFailedException':
+                logger.warning('Envelope key record for id={}, created={} no longer exists!'.format(item[PARTITION_KEY],
+                                                                                                   item[SORT_KEY]))
+                return False
+            if error_code != 'ProvisionedThroughputExceededException':
+                raise
+            logger.warning('Throttled updating id={}, created={}, retrying in {}s'.format(item[PARTITION_KEY], item[SORT_KEY],
+                                                                                          backoff))
+
+        time.sleep(backoff)
+        backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+
+
+def iter_pages(operation, **kwargs):
+    # Repeats a scan or query until every page has been read
+    while True:
+        response = operation(**kwargs)
 
-def get_all_items_to_revoke(table, created, id_prefix):
+        if response.get('Items'):
+            yield response['Items']
+
+        # No more results, break out (do-while loop). Otherwise setup for next page, which is only set now as
+        # ExclusiveStartKey doesn't accept None
+        if not response.get('LastEvaluatedKey'):
+            break
+        else:
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def build_condition_args(expression_attribute_names, **conditions):
+    # Builds the conditions into plain strings up front. Given the condition objects, boto3 builds them on every call
+    # with a single builder shared by everything using the resource, whose placeholder counters get corrupted by calls
+    # from other threads
+    builder = ConditionExpressionBuilder()
+    args = {
+        'ExpressionAttributeNames': dict(expression_attribute_names),
+        'ExpressionAttributeValues': {},
+    }
+    for name, condition in conditions.items():
+        built = builder.build_expression(condition, is_key_condition=name == 'KeyConditionExpression')
+        args[name] = built.condition_expression
+        args['ExpressionAttributeNames'].update(built.attribute_name_placeholders)
+        args['ExpressionAttributeValues'].update(built.attribute_value_placeholders)
+
+    # DynamoDB rejects an empty ExpressionAttributeValues
+    if not args['ExpressionAttributeValues']:
+        del args['ExpressionAttributeValues']
+    return args
+
+
+def iter_items_to_revoke(table, created, id_prefix, segments=1):
     # Build the filter expression we need
     created_before_key = Key(SORT_KEY).lt(created)
     id_prefix_key = Key(PARTITION_KEY).begins_with(id_prefix)
     not_revoked_attr = Attr(KEY_RECORD_REVOKED_FULLY_QUALIFIED).eq(False) | Attr(KEY_RECORD_REVOKED_FULLY_QUALIFIED).not_exists()
-    filter_expression = created_before_key & id_prefix_key & not_revoked_attr
+    filter_args = build_condition_args(REVOKE_EXPRESSION_ATTRIBUTE_NAMES,
+                                       FilterExpression=created_before_key & id_prefix_key & not_revoked_attr)
+
+    if segments <= 1:
+        for page in iter_pages_in_segment(table, filter_args):
+            yield from page
+        return
+
+    # Bounded so segments can't get more than a page each ahead of the consumer. None marks a finished segment
+    pages = queue.Queue(maxsize=segments)
+    # Set once the consumer stops, including early on an error or interrupt, so blocked segments give up
+    stopped = threading.Event()
+
+    def put_page(page):
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=QUEUE_PUT_TIMEOUT_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan_segment(segment):
+        try:
+            for page in iter_pages_in_segment(table, filter_args, segment, segments):
+                if not put_page(page):
+                    return
+        finally:
+            put_page(None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+        try:
+            futures = [executor.submit(scan_segment, segment) for segment in range(segments)]
+
+            remaining = segments
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                else:
+                    yield from page
+
+            # Propagate any error raised while scanning a segment
+            for future in futures:
+                future.result()
+        finally:
+            stopped.set()
+
+
+def iter_pages_in_segment(table, filter_args, segment=None, total_segments=None):
+    scan_args = dict(filter_args, ProjectionExpression=REVOKE_PROJECTION_EXPRESSION)
+    if total_segments:
+        scan_args['Segment'] = segment
+        scan_args['TotalSegments'] = total_segments
+
+    # The resource's client shares the table's region, endpoint and credentials, and still handles the conversion to and
+    # from DynamoDB types for us. It's only safe to call from several threads as the filter is already a string
+    return iter_pages(table.meta.client.scan, TableName=table.name, **scan_args)
+
+
+def iter_items_to_revoke_from_index(table, created, id_prefix):
+    # The index only contains items that have been through the migrate action, so the key condition replaces both the
+    # id prefix and created filters and only the revoked check is left to filter
+    key_condition_expression = Key(TYPE).eq(ID_PREFIX_TO_TYPE[id_prefix]) & Key(SORT_KEY).lt(created)
+    not_revoked_attr = Attr(KEY_RECORD_REVOKED_FULLY_QUALIFIED).eq(False) | Attr(KEY_RECORD_REVOKED_FULLY_QUALIFIED).not_exists()
 
-    results = []
-    last_evaluated_key = None
+    query_args = build_condition_args(REVOKE_EXPRESSION_ATTRIBUTE_NAMES, KeyConditionExpression=key_condition_expression,
+                                      FilterExpression=not_revoked_attr)
+
+    query_pages = iter_pages(table.query, IndexName=TYPE_CREATED_INDEX, ProjectionExpression=REVOKE_PROJECTION_EXPRESSION,
+                             **query_args)
+    for page in query_pages:
+        yield from page
+
+
+def create_type_created_index(table, execute_flag):
+    table.load()
+    if any(index['IndexName'] == TYPE_CREATED_INDEX for index in table.global_secondary_indexes or []):
+        logger.info('Index {} already exists on table {}'.format(TYPE_CREATED_INDEX, table.name))
+        return
+
+    index = {
+        'IndexName': TYPE_CREATED_INDEX,
+        'KeySchema': [
+            {'AttributeName': TYPE, 'KeyType': 'HASH'},
+            {'AttributeName': SORT_KEY, 'KeyType': 'RANGE'},
+        ],
+        # Revoked is nested within the key record, so it needs projecting in full for the query filter
+        'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': [KEY_RECORD]},
+    }
+    # On-demand tables reject a ProvisionedThroughput for the index, so only mirror the table's when it has one
+    billing_mode_summary = table.billing_mode_summary or {}
+    if billing_mode_summary.get('BillingMode') != 'PAY_PER_REQUEST':
+        index['ProvisionedThroughput'] = {
+            'ReadCapacityUnits': table.provisioned_throughput['ReadCapacityUnits'],
+            'WriteCapacityUnits': table.provisioned_throughput['WriteCapacityUnits'],
+        }
 
-    while True:
-        # Get all attributes as batch write only supports replace or delete, and ExclusiveStartKey doesn't accept None so using kwargs style
-        scan_args = dict(FilterExpression=filter_expression)
-        if last_evaluated_key:
-            scan_args['ExclusiveStartKey'] = last_evaluated_key
-        scan_response = table.scan(**scan_args)
+    if execute_flag:
+        table.update(
+            AttributeDefinitions=[
+                {'AttributeName': TYPE, 'AttributeType': 'S'},
+                {'AttributeName': SORT_KEY, 'AttributeType': 'N'},
+            ],
+            GlobalSecondaryIndexUpdates=[{'Create': index}]
+        )
+
+        logger.info('Creating index {} on table {}. It is not queryable until its status is ACTIVE'.format(
+            TYPE_CREATED_INDEX, table.name))
+    else:
+        logger.info('DRY-RUN would have created index {} on table {}'.format(TYPE_CREATED_INDEX, table.name))
 
-        if scan_response.get('Items'):
-            results.extend(scan_response['Items'])
 
-        # No more results, break out (do-while loop). Otherwise setup for next page
-        if not scan_response.get('LastEvaluatedKey'):
-            break
-        else:
-            last_evaluated_key = scan_response['LastEvaluatedKey']
+def migrate_type_attribute(table, execute_flag, write_capacity_fraction=DEFAULT_WRITE_CAPACITY_FRACTION):
+    # Only the key attributes are needed as the update below sets a single top-level attribute
+    missing_type_attr = Attr(TYPE).not_exists()
+    id_prefix_key = Key(PARTITION_KEY).begins_with('_SK_') | Key(PARTITION_KEY).begins_with('_IK_')
+    filter_expression = missing_type_attr & id_prefix_key
 
-    return results
+    rate_limiter = None
+    if execute_flag:
+        rate_limiter = create_write_rate_limiter(table, write_capacity_fraction)
+
+    count = 0
+    scan_args = build_condition_args({'#id': PARTITION_KEY, '#cr': SORT_KEY}, FilterExpression=filter_expression)
+    scan_pages = iter_pages(table.scan, ProjectionExpression='#id, #cr', **scan_args)
+    for page in scan_pages:
+        for item in page:
+            type_code = ID_PREFIX_TO_TYPE[item[PARTITION_KEY][:len('_SK_')]]
+            if not execute_flag:
+                count += 1
+            elif update_item_with_retry(table, item, rate_limiter,
+                                        UpdateExpression='set #t = :t',
+                                        ConditionExpression='attribute_exists(#kr)',
+                                        ExpressionAttributeNames={'#t': TYPE, '#kr': KEY_RECORD},
+                                        ExpressionAttributeValues={':t': type_code}):
+                count += 1
+
+    if execute_flag:
+        logger.info('Set {} attribute on {} keys successfully!'.format(TYPE, count))
+    else:
+        logger.info('DRY-RUN would have set {} attribute on {} keys'.format(TYPE, count))
 
 
 if __name__ == '__main__':
@@ -138,18 +453,42 @@ if __name__ == '__main__':
     bulk_parser.add_argument('--created-before', required=True, type=int, help='The created time cutoff')
     bulk_parser.add_argument('--type', required=True, choices=('system', 'intermediate'), help='The type of keys to revoke')
     bulk_parser.add_argument('--table', default=TABLE_NAME, help='The table name to use')
+    bulk_parser.add_argument('--use-index', action='store_true',
+                             help='Query the {} index instead of scanning the table. Keys created since the last migrate'
+                             ' action are not in the index, so run migrate immediately beforehand.'.format(TYPE_CREATED_INDEX))
+    bulk_parser.add_argument('--segments', default=DEFAULT_SEGMENTS, type=int,
+                             help='The number of segments to scan in parallel (default: %(default)s). Ignored with --use-index')
+    bulk_parser.add_argument('--write-capacity-fraction', default=DEFAULT_WRITE_CAPACITY_FRACTION, type=capacity_fraction,
+                             help='The fraction of the table\'s provisioned WCUs to use for writes (default: %(default)s).'
+                             ' Ignored for on-demand tables')
+    bulk_parser.add_argument('--max-workers', default=DEFAULT_MAX_WORKERS, type=int,
+                             help='The number of updates to run in parallel (default: %(default)s)')
+
+    migrate_parser = subparsers.add_parser('migrate', help='Create the {} index (hash={}, range={}) if missing and set the {}'
+                                           ' attribute on all system and intermediate keys that do not have it yet. WARNING:'
+                                           ' Uses Scan API.'.format(TYPE_CREATED_INDEX, TYPE, SORT_KEY, TYPE))
+    migrate_parser.add_argument('--table', default=TABLE_NAME, help='The table name to use')
+    migrate_parser.add_argument('--write-capacity-fraction', default=DEFAULT_WRITE_CAPACITY_FRACTION, type=capacity_fraction,
+                                help='The fraction of the table\'s provisioned WCUs to use for writes (default: %(default)s).'
+                                ' Ignored for on-demand tables')
 
     arguments = parser.parse_args()
 
     execute_flag = arguments.execute
 
     dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(TABLE_NAME)
+    table = dynamodb.Table(arguments.table)
     if arguments.action == 'single':
         revoke_envelope_key_record_by_key(table, execute_flag, arguments.id, arguments.created)
+    elif arguments.action == 'migrate':
+        create_type_created_index(table, execute_flag)
+        migrate_type_attribute(table, execute_flag, arguments.write_capacity_fraction)
     else:
         # bulk action
         if arguments.type == 'system':
-            revoke_system_keys_by_created(table, execute_flag, arguments.created_before)
+            revoke_system_keys_by_created(table, execute_flag, arguments.created_before, arguments.use_index,
+                                          arguments.segments, arguments.write_capacity_fraction, arguments.max_workers)
         else:
-            revoke_intermediate_keys_by_created(table, execute_flag, arguments.created_before)
+            revoke_intermediate_keys_by_created(table, execute_flag, arguments.created_before, arguments.use_index,
+                                                arguments.segments, arguments.write_capacity_fraction,
+                                                arguments.max_workers)
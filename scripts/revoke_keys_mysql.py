@@ -5,20 +5,44 @@
 # python3 -m virtualenv venv
 # source venv/bin/activate
 # pip install mysql-connector
+# pip install orjson  # optional, speeds up bulk --client-side revokes
 
 import argparse
+import concurrent.futures
+import itertools
 import json
 import logging
 import mysql.connector
+import mysql.connector.pooling
 import os
 import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_WORKERS = 1
+
 SELECT_BY_KEY_QUERY = "SELECT id, created, key_record FROM encryption_key WHERE id = %s AND created = %s"
-SELECT_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY = "SELECT id, created, key_record FROM encryption_key WHERE created < %s AND id LIKE %s"
 UPDATE_KEY_RECORD_BY_KEY_QUERY = "UPDATE encryption_key SET key_record = %s WHERE id = %s AND created = %s"
+# Handles the missing Revoked flag. Requires MySQL 5.7+ for JSON function support
+NOT_REVOKED_PREDICATE = "(JSON_EXTRACT(key_record, '$.Revoked') IS NULL OR JSON_EXTRACT(key_record, '$.Revoked') = CAST('false' AS JSON))"
+SELECT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY = ("SELECT id, created, key_record FROM encryption_key WHERE created < %s AND id LIKE %s AND "
+                                                            + NOT_REVOKED_PREDICATE)
+# Paged in primary key order, (id, created), so each page is a range read of the primary key
+SELECT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_FIRST_PAGE_QUERY = (SELECT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY
+                                                                       + " ORDER BY id, created LIMIT %s")
+SELECT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_NEXT_PAGE_QUERY = (SELECT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY
+                                                                      + " AND (id, created) > (%s, %s) ORDER BY id, created LIMIT %s")
+COUNT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY = ("SELECT COUNT(*) AS count FROM encryption_key WHERE created < %s AND id LIKE %s AND "
+                                                           + NOT_REVOKED_PREDICATE)
+REVOKE_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY = ("UPDATE encryption_key SET key_record = JSON_SET(key_record, '$.Revoked', CAST('true' AS JSON)) "
+                                                "WHERE created < %s AND id LIKE %s AND " + NOT_REVOKED_PREDICATE)
 
 
 def revoke_envelope_key_record_by_key(connection, execute_flag, id, created):
@@ -48,50 +72,140 @@ def revoke_envelope_key_record_by_key(connection, execute_flag, id, created):
         cursor.close()
 
 
-def revoke_intermediate_keys_by_created(connection, execute_flag, created):
-    return revoke_envelope_key_records_by_created_and_id_prefix(connection, execute_flag, created, "_IK_")
+def revoke_intermediate_keys_by_created(connection, execute_flag, created, client_side=False, batch_size=DEFAULT_BATCH_SIZE,
+                                        pool=None):
+    return revoke_envelope_key_records_by_created_and_id_prefix(connection, execute_flag, created, "_IK_", client_side, batch_size,
+                                                                pool)
 
 
-def revoke_system_keys_by_created(connection, execute_flag, created):
-    return revoke_envelope_key_records_by_created_and_id_prefix(connection, execute_flag, created, "_SK_")
+def revoke_system_keys_by_created(connection, execute_flag, created, client_side=False, batch_size=DEFAULT_BATCH_SIZE,
+                                  pool=None):
+    return revoke_envelope_key_records_by_created_and_id_prefix(connection, execute_flag, created, "_SK_", client_side, batch_size,
+                                                                pool)
 
 
-def revoke_envelope_key_records_by_created_and_id_prefix(connection, execute_flag, created, id_prefix):
+def revoke_envelope_key_records_by_created_and_id_prefix(connection, execute_flag, created, id_prefix, client_side=False,
+                                                         batch_size=DEFAULT_BATCH_SIZE, pool=None):
+    if client_side:
+        return revoke_envelope_key_records_in_client_by_created_and_id_prefix(connection, execute_flag, created, id_prefix,
+                                                                              batch_size, pool)
+
     cursor = connection.cursor(dictionary=True)
     try:
-        cursor.execute(SELECT_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY, (created, '{}%'.format(id_prefix)))
-        # TODO For some reason, rowcount comes back as -1. Wonder if it appears after a fetch?
-        logger.info('Fetched {} rows to revoke using id_prefix={}, created<{}'.format(cursor.rowcount, id_prefix, created))
+        if execute_flag:
+            # Single statement so the key records never leave the server, and all are revoked atomically
+            cursor.execute(REVOKE_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY, (created, '{}%'.format(id_prefix)))
+            connection.commit()
 
-        update_tuples = []
-        for row in iter_row(cursor, 100):
-            envelope_key_record_json = json.loads(row['key_record'])
-            # Only update if not already revoked and handle missing Revoked flag
-            if not envelope_key_record_json.get('Revoked') or not envelope_key_record_json['Revoked']:
+            logger.info('Marked {} keys revoked successfully using id_prefix={}, created<{}!'.format(cursor.rowcount, id_prefix,
+                                                                                                      created))
+        else:
+            cursor.execute(COUNT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY, (created, '{}%'.format(id_prefix)))
+            row = cursor.fetchone()
+
+            logger.info('DRY-RUN would have run query={} for {} keys'.format(REVOKE_BY_CREATED_BEFORE_AND_ID_PREFIX_QUERY,
+                                                                             row['count']))
+    finally:
+        cursor.close()
+
+
+def revoke_envelope_key_records_in_client_by_created_and_id_prefix(connection, execute_flag, created, id_prefix,
+                                                                  batch_size=DEFAULT_BATCH_SIZE, pool=None):
+    count = 0
+    if execute_flag:
+        # Commit per batch to bound the size of each transaction. Keys revoked by earlier batches are skipped if this is
+        # rerun after a failure, as they're no longer selected
+        if pool:
+            # Spread the batches over the pooled connections so their round trips and commits overlap, reading just
+            # enough batches ahead to keep every connection busy
+            with concurrent.futures.ThreadPoolExecutor(max_workers=pool.pool_size) as executor:
+                for window in iter_chunks(iter_update_batches(connection, created, id_prefix, batch_size), pool.pool_size):
+                    for rowcount in executor.map(lambda batch: update_key_records_with_pool(pool, batch), window):
+                        count += rowcount
+                    logger.info('Marked {} keys revoked so far'.format(count))
+        else:
+            for batch in iter_update_batches(connection, created, id_prefix, batch_size):
+                cursor = connection.cursor()
+                try:
+                    # Apparently this may not actually be optimized to a bulk update currently, but maybe it will be someday?
+                    cursor.executemany(UPDATE_KEY_RECORD_BY_KEY_QUERY, batch)
+                    connection.commit()
+
+                    count += cursor.rowcount
+                finally:
+                    cursor.close()
+                logger.info('Marked {} keys revoked so far'.format(count))
+
+        logger.info('Marked {} keys revoked successfully using id_prefix={}, created<{}!'.format(count, id_prefix, created))
+    else:
+        for batch in iter_update_batches(connection, created, id_prefix, batch_size):
+            count += len(batch)
+
+        logger.info('DRY-RUN would have run query={} for {} keys'.format(UPDATE_KEY_RECORD_BY_KEY_QUERY, count))
+
+
+def iter_update_batches(connection, created, id_prefix, batch_size):
+    # Pages through the keys in primary key order so only one batch is held in memory at a time. Paging by key, rather
+    # than reselecting until nothing is left, works whether or not earlier batches have been written yet
+    cursor = connection.cursor(dictionary=True)
+    try:
+        # Already revoked keys are filtered out by the server, so they're never sent to us
+        cursor.execute(SELECT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_FIRST_PAGE_QUERY,
+                       (created, '{}%'.format(id_prefix), batch_size))
+        rows = cursor.fetchall()
+        while rows:
+            update_tuples = []
+            for row in rows:
+                envelope_key_record_json = loads_key_record(row['key_record'])
                 envelope_key_record_json['Revoked'] = True
 
                 # Note we're appending a tuple
-                update_tuples.append((json.dumps(envelope_key_record_json, separators=(',', ":")), row['id'], row['created']))
+                update_tuples.append((dumps_key_record(envelope_key_record_json), row['id'], row['created']))
+            yield update_tuples
 
-        if update_tuples:
-            if execute_flag:
-                # Apparently this may not actually be optimized to a bulk update currently, but maybe it will be someday?
-                cursor.executemany(UPDATE_KEY_RECORD_BY_KEY_QUERY, update_tuples)
-                logger.info('Marked {} keys revoked successfully!'.format(cursor.rowcount))
-                connection.commit()
-            else:
-                logger.info('DRY-RUN would have run query={} for {} keys'.format(UPDATE_KEY_RECORD_BY_KEY_QUERY, len(update_tuples)))
+            last = rows[-1]
+            cursor.execute(SELECT_NOT_REVOKED_BY_CREATED_BEFORE_AND_ID_PREFIX_NEXT_PAGE_QUERY,
+                           (created, '{}%'.format(id_prefix), last['id'], last['created'], batch_size))
+            rows = cursor.fetchall()
     finally:
         cursor.close()
 
 
-def iter_row(cursor, size=100):
+def update_key_records_with_pool(pool, update_tuples):
+    # Closing a pooled connection returns it to the pool
+    connection = pool.get_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.executemany(UPDATE_KEY_RECORD_BY_KEY_QUERY, update_tuples)
+            connection.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+
+
+def loads_key_record(key_record):
+    if orjson:
+        return orjson.loads(key_record)
+    return json.loads(key_record)
+
+
+def dumps_key_record(envelope_key_record_json):
+    # Both produce compact output
+    if orjson:
+        return orjson.dumps(envelope_key_record_json).decode()
+    return json.dumps(envelope_key_record_json, separators=(',', ":"))
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
     while True:
-        rows = cursor.fetchmany(size)
-        if not rows:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
             break
-        for row in rows:
-            yield row
+        yield chunk
 
 
 if __name__ == '__main__':
@@ -114,21 +228,37 @@ if __name__ == '__main__':
     bulk_parser = subparsers.add_parser('bulk', help='Revoke all system or intermediate keys created before the given time')
     bulk_parser.add_argument('--created-before', required=True, help='The created time cutoff')
     bulk_parser.add_argument('--type', required=True, choices=('system', 'intermediate'), help='The type of keys to revoke')
+    bulk_parser.add_argument('--client-side', action='store_true',
+                             help='Fetch and rewrite each key record in the client instead of running a single UPDATE on the'
+                             ' server. Splits the revoke into transactions of --batch-size keys, rather than one for all keys')
+    bulk_parser.add_argument('--batch-size', default=DEFAULT_BATCH_SIZE, type=int,
+                             help='The number of keys to read and update per transaction with --client-side (default: %(default)s)')
+    bulk_parser.add_argument('--workers', default=DEFAULT_WORKERS, type=int,
+                             help='The number of pooled connections to update batches in parallel with --client-side'
+                             ' (default: %(default)s, max: 32)')
 
     arguments = parser.parse_args()
 
     execute_flag = arguments.execute
 
-    connection = mysql.connector.connect(host=arguments.host, port=arguments.port, database=arguments.database,
-                                         user=arguments.user, password=arguments.password,)
+    connection_args = dict(host=arguments.host, port=arguments.port, database=arguments.database,
+                           user=arguments.user, password=arguments.password,)
+    connection = mysql.connector.connect(**connection_args)
     try:
         if arguments.action == 'single':
             revoke_envelope_key_record_by_key(connection, execute_flag, arguments.id, arguments.created)
         else:
             # bulk action
+            pool = None
+            if arguments.client_side and arguments.workers > 1:
+                pool = mysql.connector.pooling.MySQLConnectionPool(pool_name='revoke', pool_size=arguments.workers,
+                                                                   **connection_args)
+
             if arguments.type == 'system':
-                revoke_system_keys_by_created(connection, execute_flag, arguments.created_before)
+                revoke_system_keys_by_created(connection, execute_flag, arguments.created_before, arguments.client_side,
+                                              arguments.batch_size, pool)
             else:
-                revoke_intermediate_keys_by_created(connection, execute_flag, arguments.created_before)
+                revoke_intermediate_keys_by_created(connection, execute_flag, arguments.created_before, arguments.client_side,
+                                                    arguments.batch_size, pool)
     finally:
         connection.close()
@@ -15,35 +15,65 @@ import signal
 import string
 import sys
 from types import FrameType, TracebackType
-from typing import Any, Iterator, Optional, Type
+from typing import Any, Dict, Iterator, Optional, Type
 
 import grpc
+import grpc.aio
 import appencryption_pb2
 import appencryption_pb2_grpc
 from appencryption_types import SessionRequest, SessionResponse
 
 
+_CHANNEL_OPTIONS = [('grpc.keepalive_time_ms', 30000)]
+_LETTERS = string.ascii_lowercase
+
+_shared_aio_channels: Dict[str, grpc.aio.Channel] = {}
+
+
 class SessionReceiveError(Exception):
     """Raised when a gRPC error message is received by the client."""
 
 
+def _shared_aio_channel(socket: str) -> grpc.aio.Channel:
+    """Return the channel shared by all AsyncSessionClients connected to socket."""
+
+    if socket not in _shared_aio_channels:
+        _shared_aio_channels[socket] = grpc.aio.insecure_channel(
+            f'unix://{socket}', options=_CHANNEL_OPTIONS)
+
+    return _shared_aio_channels[socket]
+
+
+async def _close_shared_aio_channels() -> None:
+    await asyncio.gather(*(channel.close() for channel in _shared_aio_channels.values()))
+    _shared_aio_channels.clear()
+
+
 class SessionClient:
     """A synchronous Session wrapper
 
     SessionClient provides a synchronous client interface for the bidirectionally-streaming Session
     endpoint.
     """
-    requests: 'queue.Queue[SessionRequest]' = queue.Queue()
-    session: Optional[Iterator]
+    __slots__ = ('requests', 'channel', 'stub', 'partition', 'session', '_enc_req', '_dec_req')
+
+    requests: 'queue.SimpleQueue[SessionRequest]'
+    # Set by _enter
+    session: Iterator
 
     def __init__(self, socket: str, partition: str) -> None:
-        self.requests = queue.Queue()
+        # gRPC consumes _next_request on its own thread, so this must still be thread-safe.
+        # SimpleQueue is a C implementation without the task tracking and condition variables of
+        # Queue
+        self.requests = queue.SimpleQueue()
 
-        self.channel = grpc.insecure_channel(f'unix://{socket}')
+        self.channel = grpc.insecure_channel(f'unix://{socket}', options=_CHANNEL_OPTIONS)
         self.stub = appencryption_pb2_grpc.AppEncryptionStub(self.channel)
         self.partition = partition
 
-        self.session = None
+        # Reused by encrypt and decrypt, and cleared once each response is received
+        self._enc_req = appencryption_pb2.SessionRequest()
+        self._dec_req = appencryption_pb2.SessionRequest()
 
     def __enter__(self) -> 'SessionClient':
         self._enter()
@@ -61,6 +91,8 @@ class SessionClient:
         self.channel.close()
 
     def _enter(self) -> None:
+        self.session = self.stub.Session(self._next_request())
+
         req = appencryption_pb2.SessionRequest()
         req.get_session.partition_id = self.partition
 
@@ -72,9 +104,6 @@ class SessionClient:
     ) -> SessionResponse:
         self.requests.put(req)
 
-        if self.session is None:
-            self.session = self.stub.Session(self._next_request())
-
         resp = next(self.session)
         if resp.HasField('error_response'):
             raise SessionReceiveError(resp.error_response.message)
@@ -94,10 +123,13 @@ class SessionClient:
             An appencryption_pb2.DataRowRecord containing the encrypted data,
             as well as its encrypted key and metadata.
         """
-        req = appencryption_pb2.SessionRequest()
+        req = self._enc_req
         req.encrypt.data = data
 
-        resp = self._send_receive(req)
+        try:
+            resp = self._send_receive(req)
+        finally:
+            req.Clear()
 
         return resp.encrypt_response.data_row_record
 
@@ -109,10 +141,121 @@ class SessionClient:
         Returns:
             The decrypted data as bytes.
         """
+        req = self._dec_req
+        req.decrypt.data_row_record.CopyFrom(drr)
+
+        try:
+            resp = self._send_receive(req)
+        finally:
+            req.Clear()
+
+        return resp.decrypt_response.data
+
+
+class AsyncSessionClient:
+    """An asyncio Session wrapper
+
+    AsyncSessionClient provides an asyncio client interface for the bidirectionally-streaming
+    Session endpoint, allowing many sessions to run concurrently on a single event loop.
+    """
+    __slots__ = ('channel', 'shared_channel', 'stub', 'partition', 'session', '_enc_req',
+                 '_dec_req')
+
+    session: Optional[grpc.aio.StreamStreamCall]
+
+    def __init__(self, socket: str, partition: str, shared_channel: bool = False) -> None:
+        # A shared channel multiplexes every session over a single connection, and outlives this
+        # client
+        self.shared_channel = shared_channel
+        if shared_channel:
+            self.channel = _shared_aio_channel(socket)
+        else:
+            self.channel = grpc.aio.insecure_channel(f'unix://{socket}', options=_CHANNEL_OPTIONS)
+        self.stub = appencryption_pb2_grpc.AppEncryptionStub(self.channel)
+        self.partition = partition
+
+        self.session = None
+
+        # Reused by encrypt and decrypt, and cleared once each response is received
+        self._enc_req = appencryption_pb2.SessionRequest()
+        self._dec_req = appencryption_pb2.SessionRequest()
+
+    async def __aenter__(self) -> 'AsyncSessionClient':
+        await self._enter()
+        return self
+
+    async def __aexit__(
+            self,
+            exc_type: Optional[Type[BaseException]],
+            exc_value: Optional[BaseException],
+            traceback: Optional[TracebackType]
+    ) -> None:
+        await self._close()
+
+    async def _close(self) -> None:
+        if self.session is not None:
+            await self.session.done_writing()
+
+        if not self.shared_channel:
+            await self.channel.close()
+
+    async def _enter(self) -> None:
+        # Without a request iterator the call is driven directly through write and read
+        self.session = self.stub.Session()
+
         req = appencryption_pb2.SessionRequest()
+        req.get_session.partition_id = self.partition
+
+        await self._send_receive(req)
+
+    async def _send_receive(
+            self,
+            req: SessionRequest,
+    ) -> SessionResponse:
+        await self.session.write(req)
+
+        resp = await self.session.read()
+        if resp is grpc.aio.EOF:
+            raise SessionReceiveError('session closed by server')
+        if resp.HasField('error_response'):
+            raise SessionReceiveError(resp.error_response.message)
+
+        return resp
+
+    async def encrypt(self, data: bytes) -> Any:
+        """Encrypt data using the current session and its partition.
+
+        Args:
+            data: A bytes object containing the data to be encrypted.
+        Returns:
+            An appencryption_pb2.DataRowRecord containing the encrypted data,
+            as well as its encrypted key and metadata.
+        """
+        req = self._enc_req
+        req.encrypt.data = data
+
+        try:
+            resp = await self._send_receive(req)
+        finally:
+            req.Clear()
+
+        return resp.encrypt_response.data_row_record
+
+    async def decrypt(self, drr: Any) -> bytes:
+        """Decrypt the data using the current session and its partition.
+
+        Args:
+            drr: An appencryption_pb2.DataRowRecord containing the data to be decrypted.
+        Returns:
+            The decrypted data as bytes.
+        """
+        req = self._dec_req
         req.decrypt.data_row_record.CopyFrom(drr)
 
-        resp = self._send_receive(req)
+        try:
+            resp = await self._send_receive(req)
+        finally:
+            req.Clear()
 
         return resp.decrypt_response.data
 
@@ -135,17 +278,17 @@ class InterruptHandler:
         signal.signal(signal.SIGTERM, self._interrupt)
 
 
-async def run_once(client: SessionClient) -> None:
+async def run_once(client: AsyncSessionClient) -> None:
     """Executes run_client_test once."""
 
-    run_client_test(client)
+    await run_client_test(client)
 
 
-async def run_continuously(client: SessionClient, handler: InterruptHandler) -> None:
+async def run_continuously(client: AsyncSessionClient, handler: InterruptHandler) -> None:
     """Executes run_client_test until the process is interrupted."""
 
     while True:
-        run_client_test(client)
+        await run_client_test(client)
 
         if handler.interrupted:
             break
@@ -157,11 +300,10 @@ async def run_continuously(client: SessionClient, handler: InterruptHandler) ->
 def random_string(length: int = 12) -> str:
     """Generate a random string of fixed length."""
 
-    letters = string.ascii_lowercase
-    return ''.join(random.choice(letters) for i in range(length))
+    return ''.join(random.choices(_LETTERS, k=length))
 
 
-def run_client_test(client: SessionClient):
+async def run_client_test(client: AsyncSessionClient):
     """Initiate a Asherah Server session, encrypt sample data, decrypt the DRR, then compare
     the decrypted data to the original.
     """
@@ -169,11 +311,11 @@ def run_client_test(client: SessionClient):
     secret = f'my "secret" data - {random_string()}'.encode()
 
     logging.info('encrypting: %s', secret)
-    drr = client.encrypt(secret)
+    drr = await client.encrypt(secret)
     logging.info('received DRR')
 
     logging.info('decrypting DRR')
-    data = client.decrypt(drr)
+    data = await client.decrypt(drr)
     logging.info('received decrypted data: %s', data)
 
     if secret != data:
@@ -192,7 +334,7 @@ async def _run_client(
     partition = f'partitionid-{partition_id}'
 
     logging.info('starting session for %s', partition)
-    with SessionClient(socket_file, partition) as client:
+    async with AsyncSessionClient(socket_file, partition, shared_channel=True) as client:
         if continuous:
             await run_continuously(client, handler)
         else:
@@ -224,6 +366,7 @@ async def _main():
     tasks = {asyncio.create_task(_run_client(args.socket, i, args.continuous, handler))
              for i in range(1, args.num_clients+1)}
     await asyncio.wait(tasks)
+    await _close_shared_aio_channels()
 
 
 if __name__ == '__main__':
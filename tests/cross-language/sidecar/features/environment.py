@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+"""Behave environment hooks
+"""
+
+import os
+
+from appencryption_client import SessionClient
+
+
+ASHERAH_SOCKET = os.getenv('ASHERAH_SOCKET_FILE', '/tmp/appencryption.sock')
+
+
+def before_all(context):
+    # One session shared by every step for the whole run, rather than connecting for each
+    context.client = SessionClient(ASHERAH_SOCKET, 'partition').__enter__()
+
+
+def after_all(context):
+    context.client.__exit__(None, None, None)
@@ -3,36 +3,45 @@
 """Decrypt feature definitions
 """
 
-import base64
-import json
+import pathlib
 
+import orjson
+import pybase64 as base64
 from behave import given, when, then
-from appencryption_client import SessionClient
 
 import appencryption_pb2
 
 
+def _data_row_record(encrypted_json):
+    key_json = encrypted_json['Key']
+    parent_key_meta_json = key_json['ParentKeyMeta']
+
+    return appencryption_pb2.DataRowRecord(
+        data=base64.b64decode(encrypted_json['Data']),
+        key=appencryption_pb2.EnvelopeKeyRecord(
+            created=key_json['Created'],
+            key=base64.b64decode(key_json['Key']),
+            parent_key_meta=appencryption_pb2.KeyMeta(
+                key_id=parent_key_meta_json['KeyId'],
+                created=parent_key_meta_json['Created'],
+            ),
+        ),
+    )
+
+
 @given(u'I have encrypted_data from "{filename}"')
 def step_impl(context, filename):
     assert filename != ''
     context.filename = '/tmp/' + filename
-    f = open(context.filename, 'r')
-    context.drr = f.read()
+    context.drr = pathlib.Path(context.filename).read_bytes()
+
+    # Decode once here so the decrypt step only covers the decrypt call
+    context.drr_proto = _data_row_record(orjson.loads(base64.b64decode(context.drr)))
 
 
 @when(u'I decrypt the encrypted_data')
 def step_impl(context):
-    with SessionClient('/tmp/appencryption.sock', 'partition') as client:
-        encrypted_json = json.loads(base64.b64decode(context.drr))
-
-        drr = appencryption_pb2.DataRowRecord()
-        drr.data = base64.b64decode(encrypted_json['Data'])
-        drr.key.created = encrypted_json['Key']['Created']
-        drr.key.key = base64.b64decode(encrypted_json['Key']['Key'])
-        drr.key.parent_key_meta.key_id = encrypted_json['Key']['ParentKeyMeta']['KeyId']
-        drr.key.parent_key_meta.created = encrypted_json['Key']['ParentKeyMeta']['Created']
-
-        context.decryptedPayload = client.decrypt(drr)
+    context.decryptedPayload = context.client.decrypt(context.drr_proto)
 
 
 @then(u'I should get decrypted_data')
@@ -3,17 +3,31 @@
 """Encrypt feature definitions
 """
 
-import base64
-import json
-import os
+import pathlib
 
+import orjson
+import pybase64 as base64
 from behave import given, when, then
-from google.protobuf.json_format import MessageToDict
 
-from appencryption_client import SessionClient
 
+def _encrypted_data(drr):
+    # The base64 encoded JSON read by every language's decrypt steps. Built straight from the
+    # message rather than through MessageToDict, which walks it reflectively
+    parent_key_meta_json = {'KeyId': drr.key.parent_key_meta.key_id,
+                            'Created': drr.key.parent_key_meta.created}
+
+    # orjson only accepts str values, which b64encode_as_string (pybase64 1.1.1+) produces
+    # without an intermediate bytes object
+    key_json = {'ParentKeyMeta': parent_key_meta_json,
+                'Key': base64.b64encode_as_string(drr.key.key),
+                'Created': drr.key.created}
+
+    drr_json = {'Data': base64.b64encode_as_string(drr.data),
+                'Key': key_json}
+
+    # orjson serializes straight to bytes, ready for encoding and writing
+    return base64.b64encode(orjson.dumps(drr_json))
 
-ASHERAH_SOCKET = os.getenv('ASHERAH_SOCKET_FILE', '/tmp/appencryption.sock')
 
 @given(u'I have "{data}"')
 def step_impl(context, data):
@@ -23,37 +37,18 @@ def step_impl(context, data):
 
 @when(u'I encrypt the data')
 def step_impl(context):
-    with SessionClient(ASHERAH_SOCKET, 'partition') as client:
-        server_drr = client.encrypt(context.payloadString.encode())
-        data_row_record = MessageToDict(server_drr)
-        parent_key_meta_json = {'KeyId': data_row_record['key']['parentKeyMeta']['keyId'],
-                                'Created': int(data_row_record['key']['parentKeyMeta']['created'])}
-
-        key_json = {'ParentKeyMeta': parent_key_meta_json,
-                    'Key': data_row_record['key']['key'],
-                    'Created': int(data_row_record['key']['created'])}
-
-        drr_json = {'Data': data_row_record['data'],
-                    'Key': key_json}
-
-        json_str = json.dumps(drr_json)
-        encoded_bytes = base64.b64encode(json_str.encode('utf-8'))
-        context.drr = encoded_bytes.decode()
+    context.drr = context.client.encrypt(context.payloadString.encode())
 
 
 @then(u'I should get encrypted_data')
 def step_impl(context):
-    assert context.drr != ''
+    assert context.drr.data != b''
     file_path = context.config.userdata['FILE']
 
-    # Remove the file if it already exists
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    f = open(file_path, 'w')
-    f.write(str(context.drr))
-    f.close()
+    # Truncates the file if it already exists
+    pathlib.Path(file_path).write_bytes(_encrypted_data(context.drr))
 
 
 @then(u'encrypted_data should not be equal to data')
 def step_impl(context):
-    assert context.payloadString != context.drr
+    assert context.payloadString.encode() != context.drr.data